@@ -1,9 +1,29 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, Response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from asgiref.wsgi import WsgiToAsgi
 import sqlite3
 import os
+import sys
+import logging
+import logging.handlers
+import threading
+import asyncio
+import hashlib
+import difflib
+import itertools
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import orjson
+import msgspec
+from typing import Annotated
 from dotenv import load_dotenv
 import requests  # <-- Needed for Otpless verification API call
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import google.generativeai as genai
 
 # Load environment variables
@@ -19,68 +39,105 @@ if not OTPLESS_SECRET_KEY:
 
 genai.configure(api_key=GEMINI_API_KEY)
 
-# Initialize Flask
-app = Flask(__name__)
-CORS(app)
+# Buffered logging: records are written to stdout in batches of 100, or
+# immediately when an ERROR comes in, instead of one write() per line.
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+logging.basicConfig(
+    level=logging.INFO,
+    handlers=[logging.handlers.MemoryHandler(100, flushLevel=logging.ERROR, target=_log_stream)]
+)
 
-@app.route("/")
-def home():
-    return "UpLyft Backend is running! 🚀"
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that encodes with orjson instead of the stdlib json module."""
 
-@app.route("/api/test")
-def test():
-    return "✅ Test route working!"
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode("utf-8")
 
-@app.route("/api/products", methods=["GET"])
-def get_products():
-    try:
-        print("📦 Fetching products from database...")
-        conn = sqlite3.connect("products.db")
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, product_name, description, price, category, image_url FROM products")
-        rows = cursor.fetchall()
-        conn.close()
-
-        products = [
-            {
-                "id": row[0],
-                "product_name": row[1],
-                "description": row[2],
-                "price": row[3],
-                "category": row[4],
-                "image_url": row[5]
-            } for row in rows
-        ]
-        return jsonify(products)
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
-    except Exception as e:
-        print(f"❌ Error fetching products: {e}")
-        return jsonify({"error": str(e)}), 500
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response, skipping the str round trip
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default), mimetype=self.mimetype)
 
-# 🧠 Gemini Chat — Fun & Flexible Assistant
-@app.route("/api/chat", methods=["POST"])
-def chat():
-    try:
-        data = request.get_json()
-        user_message = data.get("message", "")
 
-        if not user_message:
-            return jsonify({"error": "No message provided"}), 400
+# Request bodies, decoded and type-checked in one pass by msgspec
+MAX_MESSAGE_CHARS = 2000  # bounds per-request prompt size and catalog-matching work
+
 
-        # Step 1: Load product catalog
-        conn = sqlite3.connect("products.db")
-        cursor = conn.cursor()
-        cursor.execute("SELECT product_name, description FROM products")
-        rows = cursor.fetchall()
-        conn.close()
+class ChatRequest(msgspec.Struct):
+    # Length is checked in chat() so each failure gets its own error message
+    message: str = ""
 
-        catalog = "\n".join([f"{name}: {desc}" for name, desc in rows])
 
-        # Step 2: Friendly & Fun system prompt
-        system_prompt = f"""
+class OtplessVerifyRequest(msgspec.Struct):
+    otplessToken: Annotated[str, msgspec.Meta(min_length=1)]
+
+
+# Initialize Flask
+app = Flask(__name__)
+app.json = OrjsonProvider(app)
+CORS(app)
+
+DATABASE_NAME = "products.db"
+
+# SQL used by the handlers. Passing the same string every time lets sqlite3's
+# per-connection statement cache reuse the compiled statement.
+SQL_LIST = "SELECT id, product_name, description, price, category, image_url FROM products"
+# One row per distinct product, best sellers first (the CSV has one row per sale)
+SQL_CATALOG = """
+    SELECT product_name, MAX(description) FROM products
+    GROUP BY product_name ORDER BY COUNT(*) DESC
+"""
+
+# Otpless verification API URL (check Otpless docs if this changes)
+OTPLESS_VERIFY_URL = "https://api.otpless.com/v1/token/verify"
+OTPLESS_TIMEOUT = (3, 10)  # (connect, read) seconds
+
+# Pooled session so Otpless calls reuse warm TCP/TLS connections instead of a
+# fresh handshake each time. It is called from async views via asyncio.to_thread:
+# Flask gives every async view its own event loop, so an async client's pool
+# could not survive between requests, while this one lives for the process.
+OTPLESS_HTTP = requests.Session()
+OTPLESS_HTTP.mount("https://", HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    # Only retry failed connects: Otpless tokens are single-use, so re-sending a
+    # verify POST after a read timeout or 5xx could present an already-spent
+    # token and turn a valid login into a 401.
+    max_retries=Retry(total=3, connect=3, read=0, status=0, backoff_factor=0.2)
+))
+
+GEMINI_MODEL_NAME = "gemini-1.5-flash"
+
+# Bounds on what goes into the prompt. The system instruction carries the top
+# CATALOG_MAX_ITEMS products (roughly 4k tokens); each question additionally
+# gets up to CATALOG_MATCHES products whose names fuzzy-match its words.
+CATALOG_MAX_ITEMS = 300
+CATALOG_MATCHES = 10
+CATALOG_MATCH_WORDS = 12  # question words fuzzy-matched per request
+# Words never used for matching: English filler, plus any word found in more
+# than CATALOG_COMMON_WORD_SHARE of product names (at least CATALOG_COMMON_WORD_MIN)
+CATALOG_STOPWORDS = frozenset("""
+    a an and any are but can do does for from have how i in is it me my of off on or
+    our show some tell that the their them there these this those to what which
+    with you your about want need like got get has all
+    set sets pack packs box
+""".split())
+CATALOG_COMMON_WORD_SHARE = 0.05
+CATALOG_COMMON_WORD_MIN = 20
+CATALOG_NAME_CHARS = 80
+CATALOG_DESC_CHARS = 160
+
+# Gemini system instruction. It only depends on the catalog, so it is rendered
+# (and the model built) once per catalog load; requests send just the question.
+SYSTEM_INSTRUCTION_TEMPLATE = """
 You are UpLyft Assistant 🤖🛍️ — witty, helpful, and full of energy!
 
-Here's the UpLyft product catalog:
+Here's the UpLyft product catalog (best sellers; products matching the user's
+question are listed with their message):
 --- CATALOG START ---
 {catalog}
 --- CATALOG END ---
@@ -97,39 +154,385 @@ Guidelines:
 Example:
 User: do you sell watches?
 Assistant: ⌚ Hmm, I wish we did! But no watches here yet. Wanna see what’s hot in our current collection? 🔥
+"""
 
-Now answer this:
+MATCHES_PROMPT_TEMPLATE = """Catalog products matching this question:
+{matches}
+
+User: {user}"""
+
+# 📚 Catalog cache — rebuilt only when products.db changes on disk
+_CATALOG_CACHE = {"text": None, "lines": {}, "words": {}, "buckets": {}, "rank": {}, "model": None, "mtime": 0.0}
+_CATALOG_LOCK = threading.Lock()
+
+
+_DB_LOCK = threading.Lock()
+
+
+# Same tuning as import_products.py, plus a warm page cache for the read path
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",    # 64 MB page cache
+    "PRAGMA mmap_size=268435456",  # 256 MB memory-mapped I/O
+)
+
+
+def _open_db():
+    conn = sqlite3.connect(DATABASE_NAME, check_same_thread=False)
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def get_db():
+    """
+    Return the process-wide SQLite connection, opening it on first use.
+    Opening lazily keeps the handle out of gunicorn's --preload master, so every
+    forked worker gets its own connection instead of sharing one across fork().
+    """
+    if "db" not in g:
+        with _DB_LOCK:
+            if getattr(app, "db", None) is None:
+                app.db = _open_db()
+        g.db = app.db
+    return g.db
+
+
+@app.teardown_appcontext
+def _release_db(exc):
+    # The shared handle outlives the request; only drop this request's reference.
+    g.pop("db", None)
+
+
+def _db_mtime():
+    # In WAL mode commits land in products.db-wal until a checkpoint runs,
+    # so the newest of the two files tells us when the data last changed.
+    # Open the shared connection first: its switch to WAL creates the -wal
+    # file, which would otherwise look like a data change on the next call.
+    get_db()
+    wal = DATABASE_NAME + "-wal"
+    mtime = os.path.getmtime(DATABASE_NAME)
+    if os.path.exists(wal):
+        mtime = max(mtime, os.path.getmtime(wal))
+    return mtime
+
+
+def _load_catalog():
+    """Return the cached catalog entry, re-reading SQLite only if the DB changed."""
+    mtime = _db_mtime()
+    db = get_db()
+    with _CATALOG_LOCK:
+        if _CATALOG_CACHE["text"] is None or _CATALOG_CACHE["mtime"] != mtime:
+            # Stream rows straight off the cursor instead of fetchall()ing a list first
+            cursor = db.execute(SQL_CATALOG)
+
+            # name -> trimmed catalog line, and name word -> names (for matching)
+            lines = {}
+            words = {}
+            for name, desc in cursor:
+                line = name[:CATALOG_NAME_CHARS]
+                if desc:
+                    line += f": {desc[:CATALOG_DESC_CHARS]}"
+                lines[name] = line
+                for word in set(_words(name)):
+                    if word not in CATALOG_STOPWORDS:
+                        words.setdefault(word, []).append(name)
+
+            # Words shared by a large slice of the catalog ("set", "pack", ...)
+            # say nothing about which product a question is about
+            common = max(CATALOG_COMMON_WORD_MIN, len(lines) * CATALOG_COMMON_WORD_SHARE)
+            words = {word: names for word, names in words.items() if len(names) <= common}
+
+            catalog = "\n".join(itertools.islice(lines.values(), CATALOG_MAX_ITEMS))
+            _CATALOG_CACHE["text"] = catalog
+            _CATALOG_CACHE["lines"] = lines
+            _CATALOG_CACHE["rank"] = {name: i for i, name in enumerate(lines)}
+            _CATALOG_CACHE["words"] = words
+            # Fuzzy lookups only compare words sharing the first letter
+            buckets = {}
+            for word in words:
+                buckets.setdefault(word[0], []).append(word)
+            _CATALOG_CACHE["buckets"] = buckets
+            _CATALOG_CACHE["model"] = genai.GenerativeModel(
+                GEMINI_MODEL_NAME,
+                system_instruction=SYSTEM_INSTRUCTION_TEMPLATE.format(catalog=catalog)
+            )
+            _CATALOG_CACHE["mtime"] = mtime
+        return dict(_CATALOG_CACHE)
+
+
+def _words(text):
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+def _catalog_matches(catalog, message):
+    """Catalog lines for the products sharing the most (fuzzy-matched) words with the message."""
+    words = catalog["words"]
+    # Dedupe, keep message order, and only look at the first few real words:
+    # each fuzzy lookup scans every vocabulary word with the same first letter.
+    candidates = [
+        word for word in dict.fromkeys(_words(message))
+        if len(word) >= 3 and word not in CATALOG_STOPWORDS
+    ]
+    scores = {}  # name -> number of question words it matched
+    for word in candidates[:CATALOG_MATCH_WORDS]:
+        # Exact hits (including a plain plural -> singular) skip the fuzzy scan
+        close_words = [w for w in (word, word[:-1] if word.endswith("s") else None) if w in words]
+        if not close_words:
+            bucket = catalog["buckets"].get(word[0], [])
+            close_words = difflib.get_close_matches(word, bucket, n=3, cutoff=0.8)
+        matched = {name for close in close_words for name in words[close]}
+        for name in matched:
+            scores[name] = scores.get(name, 0) + 1
+
+    # Best-matching first; ties keep catalog (best seller) order
+    rank = catalog["rank"]
+    best = sorted(scores, key=lambda name: (-scores[name], rank[name]))
+    return [catalog["lines"][name] for name in best[:CATALOG_MATCHES]]
+    return list(matches.values())
+
+
+# 💬 Reply cache — exact match on the normalized question, then a semantic
+# match on Gemini embeddings so near-duplicates skip the generation call too.
+REPLY_CACHE_SIZE = 512
+SEMANTIC_MATCH_THRESHOLD = 0.92
+EMBEDDING_MODEL = "models/text-embedding-004"
+
+# replies: key -> (reply, unit embedding or None), oldest first.
+# matrix/keys are the stacked embeddings, rebuilt lazily after any change.
+_REPLY_CACHE = {"mtime": None, "replies": OrderedDict(), "matrix": None, "keys": []}
+_REPLY_LOCK = threading.Lock()
+_EMBED_POOL = ThreadPoolExecutor(max_workers=2)  # embeddings for newly stored replies
+
+
+def _normalize(message):
+    return " ".join(message.lower().split()).strip(" ?!.")
+
+
+def _reply_key(message):
+    return hashlib.blake2b(_normalize(message).encode("utf-8")).hexdigest()
+
+
+def _embed(message):
+    """Unit-length embedding of the question, or None if the API call fails."""
+    try:
+        result = genai.embed_content(
+            model=EMBEDDING_MODEL,
+            content=_normalize(message),
+            task_type="semantic_similarity"
+        )
+    except Exception as e:
+        app.logger.warning("⚠️ Embedding failed, skipping semantic cache: %s", e)
+        return None
+    vector = np.asarray(result["embedding"], dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else None
+
+
+def _sync_reply_cache(mtime):
+    # Cached replies describe the old catalog, so drop them when it changes.
+    # Caller must hold _REPLY_LOCK.
+    if _REPLY_CACHE["mtime"] != mtime:
+        _REPLY_CACHE["replies"].clear()
+        _REPLY_CACHE["matrix"] = None
+        _REPLY_CACHE["keys"] = []
+        _REPLY_CACHE["mtime"] = mtime
+
+
+def _cached_reply(key, mtime):
+    with _REPLY_LOCK:
+        _sync_reply_cache(mtime)
+        entry = _REPLY_CACHE["replies"].get(key)
+        if entry is None:
+            return None
+        _REPLY_CACHE["replies"].move_to_end(key)
+        return entry[0]
+
+
+def _similar_reply(vector, mtime):
+    if vector is None:
+        return None
+    with _REPLY_LOCK:
+        _sync_reply_cache(mtime)
+        replies = _REPLY_CACHE["replies"]
+        if _REPLY_CACHE["matrix"] is None:
+            keys = [key for key, (_, vec) in replies.items() if vec is not None]
+            if not keys:
+                return None
+            _REPLY_CACHE["keys"] = keys
+            _REPLY_CACHE["matrix"] = np.stack([replies[key][1] for key in keys])
+
+        # Rows and the query are unit vectors, so the dot product is the cosine.
+        sims = _REPLY_CACHE["matrix"] @ vector
+        best = int(np.argmax(sims))
+        if sims[best] < SEMANTIC_MATCH_THRESHOLD:
+            return None
+        key = _REPLY_CACHE["keys"][best]
+        replies.move_to_end(key)
+        return replies[key][0]
+
+
+def _has_vectors(mtime):
+    """Whether the semantic layer has anything to compare a new question with."""
+    with _REPLY_LOCK:
+        _sync_reply_cache(mtime)
+        return any(vec is not None for _, vec in _REPLY_CACHE["replies"].values())
+
+
+def _store_reply(key, message, vector, reply, mtime):
+    with _REPLY_LOCK:
+        _sync_reply_cache(mtime)
+        replies = _REPLY_CACHE["replies"]
+        replies[key] = (reply, vector)
+        replies.move_to_end(key)
+        while len(replies) > REPLY_CACHE_SIZE:
+            replies.popitem(last=False)
+        _REPLY_CACHE["matrix"] = None
+    if vector is None:
+        # Embed in the background so the request never waits on it
+        _EMBED_POOL.submit(_attach_vector, key, message, mtime)
+
+
+def _attach_vector(key, message, mtime):
+    vector = _embed(message)
+    if vector is None:
+        return
+    with _REPLY_LOCK:
+        replies = _REPLY_CACHE["replies"]
+        # Skip if the catalog changed or the entry was evicted meanwhile
+        if _REPLY_CACHE["mtime"] != mtime or key not in replies:
+            return
+        replies[key] = (replies[key][0], vector)  # keeps its LRU position
+        _REPLY_CACHE["matrix"] = None
+
+
+def _sse(payload):
+    return f"data: {app.json.dumps(payload)}\n\n"
+
+
+def _event_stream(events):
+    return Response(stream_with_context(events), mimetype="text/event-stream")
 
-User: {user_message}
-Assistant:
-"""
 
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        response = model.generate_content(system_prompt)
+@app.route("/")
+def home():
+    return "UpLyft Backend is running! 🚀"
+
+@app.route("/api/test")
+def test():
+    return "✅ Test route working!"
+
+# 📦 Serialized product list, keyed on the DB mtime (also used as the ETag)
+PRODUCTS_MAX_AGE = 60  # seconds clients may reuse /api/products without asking
+_PRODUCTS_CACHE = {"etag": None, "body": None}
+_PRODUCTS_LOCK = threading.Lock()
+
+
+def _cacheable(response, etag):
+    # 200s and 304s must carry the same validators and caching headers
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = PRODUCTS_MAX_AGE
+    return response
+
+
+@app.route("/api/products", methods=["GET"])
+def get_products():
+    try:
+        etag = format(int(_db_mtime() * 1_000_000), "x")
+        if request.if_none_match.contains_weak(etag):  # If-None-Match uses weak comparison
+            return _cacheable(Response(status=304), etag)
+
+        with _PRODUCTS_LOCK:
+            if _PRODUCTS_CACHE["etag"] != etag:
+                app.logger.debug("📦 Fetching products from database...")
+                # Read column-wise in pandas' C loop and encode straight to JSON,
+                # without building a Python dict per product
+                df = pd.read_sql_query(SQL_LIST, get_db())
+                _PRODUCTS_CACHE["body"] = df.to_json(orient="records", double_precision=15).encode("utf-8")
+                _PRODUCTS_CACHE["etag"] = etag
+            body = _PRODUCTS_CACHE["body"]
+
+        return _cacheable(app.response_class(body, mimetype="application/json"), etag)
+
+    except Exception as e:
+        app.logger.exception("❌ Error fetching products")
+        return jsonify({"error": str(e)}), 500
 
-        if hasattr(response, "text"):
-            return jsonify({"reply": response.text})
-        else:
-            return jsonify({"error": "No valid response from Gemini."}), 500
+# 🧠 Gemini Chat — Fun & Flexible Assistant
+@app.route("/api/chat", methods=["POST"])
+async def chat():
+    try:
+        try:
+            body = msgspec.json.decode(request.get_data(cache=False), type=ChatRequest)
+        except msgspec.DecodeError as e:  # bad JSON, or ValidationError (wrong type)
+            return jsonify({"error": "Invalid request body", "details": str(e)}), 400
+        user_message = body.message
+
+        if not user_message:
+            return jsonify({"error": "No message provided"}), 400
+        if len(user_message) > MAX_MESSAGE_CHARS:
+            return jsonify({"error": f"Message too long (max {MAX_MESSAGE_CHARS} characters)"}), 400
+
+        # Step 1: Load product catalog + Gemini model with the fun system prompt (cached)
+        catalog = _load_catalog()
+
+        # Step 2: Answer repeat / near-duplicate questions from the reply cache
+        key = _reply_key(user_message)
+        reply = _cached_reply(key, catalog["mtime"])
+        vector = None
+        # Only pay for an embedding round-trip when there is something to match
+        if reply is None and _has_vectors(catalog["mtime"]):
+            vector = await asyncio.to_thread(_embed, user_message)
+            reply = _similar_reply(vector, catalog["mtime"])
+        if reply is not None:
+            return _event_stream(iter([_sse({"reply": reply})]))
+
+        # Step 3: Send the question plus the few products it seems to be about;
+        # the bounded catalog itself lives in the system instruction.
+        matches = _catalog_matches(catalog, user_message)
+        content = user_message
+        if matches:
+            content = MATCHES_PROMPT_TEMPLATE.format(matches="\n".join(matches), user=user_message)
+
+        # Run the blocking SDK call off the event loop. Flask gives every async
+        # view its own loop, and the SDK's cached grpc.aio client is bound to
+        # the first loop it sees, so generate_content_async can't be reused here.
+        model = catalog["model"]
+        response = await asyncio.to_thread(model.generate_content, content, stream=True)
+
+        # Step 4: Stream chunks to the client as Gemini produces them
+        def generate():
+            parts = []
+            try:
+                for chunk in response:
+                    parts.append(chunk.text)
+                    yield _sse({"reply": chunk.text})
+            except Exception:
+                app.logger.exception("❌ Error while streaming /api/chat")
+                yield _sse({"error": "No valid response from Gemini."})
+                return
+            _store_reply(key, user_message, vector, "".join(parts), catalog["mtime"])
+
+        return _event_stream(generate())
 
     except Exception as e:
-        print(f"❌ Error in /api/chat: {e}")
+        app.logger.exception("❌ Error in /api/chat")
         return jsonify({"error": str(e)}), 500
 
 
 # ----------- NEW: Otpless verification endpoint -----------
 
 @app.route("/api/auth/otpless-verify", methods=["POST"])
-def otpless_verify():
+async def otpless_verify():
     try:
-        data = request.get_json()
-        token = data.get("otplessToken")
-
-        if not token:
+        try:
+            body = msgspec.json.decode(request.get_data(cache=False), type=OtplessVerifyRequest)
+        except msgspec.DecodeError:  # also covers ValidationError (missing/empty token)
             return jsonify({"message": "Missing otplessToken"}), 400
-
-        # Otpless verification API URL (check Otpless docs if this changes)
-        verify_url = "https://api.otpless.com/v1/token/verify"
+        token = body.otplessToken
 
         headers = {
             "Authorization": f"Bearer {OTPLESS_SECRET_KEY}",
@@ -140,7 +543,10 @@ def otpless_verify():
             "token": token
         }
 
-        response = requests.post(verify_url, json=payload, headers=headers)
+        response = await asyncio.to_thread(
+            OTPLESS_HTTP.post, OTPLESS_VERIFY_URL,
+            json=payload, headers=headers, timeout=OTPLESS_TIMEOUT
+        )
 
         if response.status_code != 200:
             return jsonify({
@@ -165,10 +571,14 @@ def otpless_verify():
             "user": user_info
         }), 200
 
-    except Exception as e:
-        print(f"❌ Error in /api/auth/otpless-verify: {e}")
+    except Exception:
+        app.logger.exception("❌ Error in /api/auth/otpless-verify")
         return jsonify({"message": "Internal server error"}), 500
 
 
+# ASGI entry point: gunicorn -k uvicorn.workers.UvicornWorker app:asgi_app
+asgi_app = WsgiToAsgi(app)
+
+# Development server only; production runs under gunicorn (see Procfile)
 if __name__ == "__main__":
-    app.run(debug=True)
+    app.run(debug=os.getenv("FLASK_DEBUG") == "1")
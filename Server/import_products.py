@@ -1,26 +1,131 @@
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import sqlite3
+import csv
+import os
+import shutil
+import subprocess
+import tempfile
 import math # Import math to check for NaN values
 
 # --- Configuration ---
 DATABASE_NAME = "products.db"
 CSV_FILE = "data.csv" # Make sure this file is in the same directory as this script
+CSV_COLUMNS = ["Description", "UnitPrice"] # The only CSV columns the import uses
+CSV_BLOCK_SIZE = 4 * 1024 * 1024 # Bytes parsed per chunk (~50k rows of the retail CSV)
+
+# WAL + relaxed fsync: the import becomes sequential WAL appends instead of a
+# rollback-journal fsync per commit, and readers never block on the import.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",    # 64 MB page cache
+    "PRAGMA mmap_size=268435456",  # 256 MB memory-mapped I/O
+)
+
+# sqlite3 command-line shell, if installed. Its .import parses and inserts the
+# file entirely in C; without it we fall back to executemany from Python.
+SQLITE_CLI = shutil.which("sqlite3")
+STAGING_TABLE = "products_import"
+
+def clean_products(df):
+    """
+    Validate CSV rows with column operations only (no per-row Python loop).
+    Returns (clean_df, skipped) where clean_df has product_name and price columns
+    and skipped maps each skip reason to its row count.
+    """
+    # --- IMPORTANT: Map CSV column names to DB schema names EXACTLY ---
+    # Description -> product_name, UnitPrice -> price. The other DB columns
+    # (description, category, image_url) are not in your CSV, so they stay NULL.
+    raw_price = df["UnitPrice"]
+    name = df["Description"].astype("string").str.strip().replace("", pd.NA)
+    price = pd.to_numeric(raw_price, errors="coerce") # unparseable values become NaN
+
+    # --- Data Validation before insertion (Crucial for NOT NULL constraints) ---
+    missing_name = name.isna()
+    bad = missing_name | price.isna()
+    skipped = {
+        "'Description' (product_name) is missing or empty.": int(missing_name.sum()),
+        "'UnitPrice' (price) is missing.": int((raw_price.isna() & ~missing_name).sum()),
+        "'UnitPrice' is not a valid number.": int((price.isna() & raw_price.notna() & ~missing_name).sum()),
+    }
+
+    clean = pd.DataFrame({"product_name": name[~bad], "price": price[~bad].astype(float)})
+    return clean, skipped
+
+def iter_clean_batches(reader, stats):
+    """Yield a cleaned DataFrame per Arrow batch, tallying counts into stats."""
+    for batch in reader:
+        df, chunk_skipped = clean_products(batch.to_pandas())
+        stats["read"] += batch.num_rows
+        stats["imported"] += len(df)
+        for reason, count in chunk_skipped.items():
+            stats["skipped"][reason] = stats["skipped"].get(reason, 0) + count
+        yield df
+
+def bulk_load_tsv(tsv_path):
+    """
+    Load a product_name<TAB>price file through the sqlite3 shell's native .import.
+    Rows land in a staging table first (products has an autoincrement id the file
+    doesn't carry), then move into products in a single transaction.
+    """
+    script = "\n".join([f"{pragma};" for pragma in SQLITE_PRAGMAS] + [
+        f"DROP TABLE IF EXISTS {STAGING_TABLE};",
+        f"CREATE TABLE {STAGING_TABLE} (product_name TEXT NOT NULL, price REAL NOT NULL);",
+        ".mode tabs",
+        f'.import "{tsv_path}" {STAGING_TABLE}',
+        "BEGIN;",
+        f"INSERT INTO products (product_name, price) SELECT product_name, price FROM {STAGING_TABLE};",
+        f"DROP TABLE {STAGING_TABLE};",
+        "COMMIT;",
+    ]) + "\n"
+    result = subprocess.run([SQLITE_CLI, "-bail", DATABASE_NAME], input=script,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"sqlite3 .import failed: {result.stderr.strip()}")
 
 def import_products():
     conn = None # Initialize conn to None
     try:
-        # Step 1: Read the CSV file using pandas
+        # Step 1: Check the header before handing the file to Arrow. A missing
+        # column makes open_csv fail inside its transcoding reader, which can
+        # leave the process hanging at exit instead of just reporting the error.
+        with open(CSV_FILE, encoding="latin-1", newline="") as f:
+            header = next(csv.reader(f), None)
+        if not header:
+            print(f"Error: The file '{CSV_FILE}' is empty.")
+            return
+        missing_columns = [column for column in CSV_COLUMNS if column not in header]
+        if missing_columns:
+            print(f"Error: The file '{CSV_FILE}' is missing required column(s): {', '.join(missing_columns)}")
+            print(f"Columns found: {header}")
+            return
+
+        # Open the CSV as a stream of Arrow record batches
         # Keep 'latin-1' encoding as it seemed to work for the previous UnicodeDecodeError.
-        df = pd.read_csv(CSV_FILE, encoding='latin-1')
-        print(f"Successfully read {len(df)} rows from {CSV_FILE}")
+        # Both columns are read as plain strings; clean_products() does the parsing,
+        # so a bad value in a later chunk can't break Arrow's type inference.
+        reader = pa_csv.open_csv(
+            CSV_FILE,
+            read_options=pa_csv.ReadOptions(encoding="latin1", block_size=CSV_BLOCK_SIZE),
+            convert_options=pa_csv.ConvertOptions(
+                include_columns=CSV_COLUMNS,
+                column_types={column: pa.string() for column in CSV_COLUMNS},
+                strings_can_be_null=True # empty fields -> null, like pandas' NaN
+            )
+        )
 
-        # --- DEBUG STEP: Print actual column names recognized by pandas ---
-        print("\n--- CSV Columns detected by Pandas ---")
-        print(df.columns.tolist()) # Convert to list for cleaner print
-        print("--------------------------------------\n")
+        # --- DEBUG STEP: Print the CSV columns the import reads ---
+        print("\n--- CSV Columns read by Arrow ---")
+        print(reader.schema.names)
+        print("---------------------------------\n")
 
         # Step 2: Connect to SQLite database
         conn = sqlite3.connect(DATABASE_NAME)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
         cursor = conn.cursor()
 
         # Step 3: Create products table if it doesn't exist
@@ -35,62 +140,46 @@ def import_products():
                 image_url TEXT
             )
         ''')
+        # Covering index for the chatbot's catalog query (product_name, description),
+        # so the app can read it without touching the table rows.
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_products_catalog
+            ON products (product_name, description)
+        ''')
         print(f"Table 'products' ensured in {DATABASE_NAME}")
 
-        # Step 4: Insert data into the products table
-        imported_count = 0
-        skipped_count = 0
-        for index, row in df.iterrows():
-            # --- IMPORTANT: Map CSV column names to DB schema names EXACTLY ---
-            product_name_from_csv = row.get('Description') # Maps to DB's product_name
-            price_from_csv = row.get('UnitPrice')        # Maps to DB's price
-
-            # For other DB columns, they are not directly in your CSV, so we set them to None or a default
-            # You might want to derive category from Description or StockCode later if needed.
-            description_for_db = None # Not available as a separate long description in your CSV
-            category_for_db = None    # Not available in your CSV
-            image_url_for_db = None   # Not available in your CSV
-
-            # --- Data Validation before insertion (Crucial for NOT NULL constraints) ---
-            # Check for missing Description
-            if pd.isna(product_name_from_csv) or str(product_name_from_csv).strip() == '':
-                print(f"Skipping row {index}: 'Description' (product_name) is missing or empty.")
-                skipped_count += 1
-                continue # Skip this row
-
-            # Check for missing or invalid UnitPrice
-            if pd.isna(price_from_csv):
-                print(f"Skipping row {index}: 'UnitPrice' (price) is missing.")
-                skipped_count += 1
-                continue # Skip this row
-
-            try:
-                # Convert price to float. If it's a string that can't be converted, it will raise ValueError.
-                price_value = float(price_from_csv)
-            except ValueError:
-                print(f"Skipping row {index}: 'UnitPrice' ('{price_from_csv}') is not a valid number.")
-                skipped_count += 1
-                continue # Skip this row
-            except TypeError: # Catches cases where price_from_csv might be a list or other unconvertible type
-                print(f"Skipping row {index}: 'UnitPrice' has an unexpected type: {type(price_from_csv)}.")
-                skipped_count += 1
-                continue # Skip this row
-            
-            # --- Insert Validated Data ---
-            cursor.execute('''
-                INSERT INTO products (product_name, description, price, category, image_url)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (
-                str(product_name_from_csv).strip(), # Ensure product name is a string and trimmed
-                description_for_db,
-                price_value,
-                category_for_db,
-                image_url_for_db
-            ))
-            imported_count += 1
-        
-        # Step 5: Commit changes and close connection
-        conn.commit()
+        # Step 4: Validate chunk by chunk and bulk-load the clean rows
+        stats = {"read": 0, "imported": 0, "skipped": {}}
+        if SQLITE_CLI:
+            # --- Native path: spool clean rows to a TSV, let sqlite3 .import load it ---
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                tsv_path = os.path.join(tmp_dir, "products.tsv")
+                with open(tsv_path, "w", encoding="utf-8", newline="") as tsv:
+                    for df in iter_clean_batches(reader, stats):
+                        df.to_csv(tsv, sep="\t", header=False, index=False)
+                bulk_load_tsv(tsv_path)
+        else:
+            # --- Fallback: one prepared statement per chunk, all in one transaction ---
+            with conn:  # commits on success, rolls back on error
+                for df in iter_clean_batches(reader, stats):
+                    cursor.executemany('''
+                        INSERT INTO products (product_name, description, price, category, image_url)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', zip(
+                        df["product_name"],
+                        [None] * len(df),
+                        df["price"],
+                        [None] * len(df),
+                        [None] * len(df)
+                    ))
+        print(f"Successfully read {stats['read']} rows from {CSV_FILE}")
+        for reason, count in stats["skipped"].items():
+            if count:
+                print(f"Skipping {count} rows: {reason}")
+        imported_count = stats["imported"]
+        skipped_count = sum(stats["skipped"].values())
+
+        # Step 5: Report (the transaction above has already been committed)
         print(f"\nImport process completed!")
         print(f"Successfully imported {imported_count} products into {DATABASE_NAME}.")
         if skipped_count > 0:
@@ -99,8 +188,10 @@ def import_products():
     except FileNotFoundError:
         print(f"Error: The file '{CSV_FILE}' was not found in the same directory as the script.")
         print("Please ensure 'data.csv' exists and is in the 'Server' folder.")
-    except pd.errors.EmptyDataError:
-        print(f"Error: The file '{CSV_FILE}' is empty.")
+    except pa.ArrowKeyError as e:
+        print(f"Error: The file '{CSV_FILE}' is missing a required column: {e}")
+    except pa.ArrowInvalid as e:
+        print(f"Error: The file '{CSV_FILE}' could not be parsed as CSV: {e}")
     except Exception as e:
         print(f"An unexpected error occurred during import: {e}")
         print("Please review your CSV file for unexpected data formats or column issues.")